@@ -0,0 +1,271 @@
+"""
+라우터 부하 생성기
+
+/route, /batch, /health 를 지정한 동시성으로 호출하여 처리량, p50/p95/p99 지연,
+이벤트 루프 지연을 측정하고 결과를 JSON으로 저장한다 (커밋 간 비교용).
+
+- 라우터 이벤트 루프 지연: 실행 전후로 /metrics 의 event_loop_lag_seconds 히스토그램을 읽어 차분
+- 부하 생성기 자신의 루프 지연도 함께 기록 (값이 크면 클라이언트가 병목이므로 결과를 신뢰하지 말 것)
+
+사용 예:
+    python bench/load.py --endpoint route --concurrency 16 --requests 500
+    python bench/load.py --endpoint batch --batch-size 8 --duration 30 --compare bench/results/<이전 결과>.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import subprocess
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+LOOP_LAG_METRIC = "llm_router_event_loop_lag_seconds"
+COMPARE_KEYS = ["throughput_rps", "latency_ms.p50", "latency_ms.p95", "latency_ms.p99", "router_loop_lag_ms.p99"]
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """nearest-rank 백분위수 (sorted_values는 오름차순)"""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(q / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+
+def summarize(values_ms: List[float]) -> Dict[str, float]:
+    values = sorted(values_ms)
+    return {
+        "p50": round(percentile(values, 50), 2),
+        "p95": round(percentile(values, 95), 2),
+        "p99": round(percentile(values, 99), 2),
+        "mean": round(sum(values) / len(values), 2) if values else 0.0,
+        "max": round(values[-1], 2) if values else 0.0,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True, cwd=Path(__file__).resolve().parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ── 라우터 이벤트 루프 지연 (/metrics 히스토그램 차분) ──
+
+def parse_histogram(text: str, metric: str) -> Dict[str, Any]:
+    """Prometheus 텍스트에서 히스토그램 하나를 {buckets: {le: count}, sum, count}로 추출"""
+    histogram: Dict[str, Any] = {"buckets": {}, "sum": 0.0, "count": 0.0}
+    for line in text.splitlines():
+        if not line.startswith(metric):
+            continue
+        name, _, value = line.rpartition(" ")
+        if name.startswith(f"{metric}_bucket"):
+            bound = name.split('le="', 1)[1].split('"', 1)[0]
+            histogram["buckets"][bound] = float(value)
+        elif name == f"{metric}_sum":
+            histogram["sum"] = float(value)
+        elif name == f"{metric}_count":
+            histogram["count"] = float(value)
+    return histogram
+
+
+def histogram_delta(before: Dict[str, Any], after: Dict[str, Any]) -> Dict[str, float]:
+    """두 시점 히스토그램의 차이로 구간 내 관측값의 백분위수(버킷 상한) 추정 (ms)"""
+    count = after["count"] - before["count"]
+    if count <= 0:
+        return {"samples": 0}
+    bounds = sorted((bound for bound in after["buckets"] if bound != "+Inf"), key=float)
+
+    def quantile(q: float) -> Optional[float]:
+        for bound in bounds:
+            if after["buckets"][bound] - before["buckets"].get(bound, 0.0) >= q * count:
+                return float(bound) * 1000
+        return None  # 가장 큰 버킷보다 큼
+
+    return {
+        "samples": int(count),
+        "mean": round((after["sum"] - before["sum"]) / count * 1000, 2),
+        "p50": quantile(0.50),
+        "p95": quantile(0.95),
+        "p99": quantile(0.99),
+    }
+
+
+async def scrape_loop_lag(client: httpx.AsyncClient) -> Optional[Dict[str, Any]]:
+    try:
+        response = await client.get("/metrics")
+        response.raise_for_status()
+    except httpx.HTTPError:
+        return None
+    return parse_histogram(response.text, LOOP_LAG_METRIC)
+
+
+async def client_loop_lag(samples: List[float], interval: float = 0.05):
+    """부하 생성기 자신의 이벤트 루프 지연 기록 (ms)"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        samples.append(max(loop.time() - expected, 0.0) * 1000)
+
+
+# ── 요청 본문 ──
+
+def route_request(args: argparse.Namespace, i: int) -> Dict[str, Any]:
+    # unique면 요청마다 프롬프트를 달리해 라우팅/응답 캐시와 single-flight를 우회
+    prompt = f"{args.prompt} #{i}" if args.unique else args.prompt
+    request: Dict[str, Any] = {"prompt": prompt, "max_tokens": args.max_tokens, "temperature": args.temperature}
+    if args.external_doc_kb:
+        line = "benchmark document line\n"
+        request["external_doc"] = (line * (args.external_doc_kb * 1024 // len(line) + 1))[:args.external_doc_kb * 1024]
+    return request
+
+
+def build_call(args: argparse.Namespace, i: int) -> tuple:
+    """(method, path, json body, 처리 항목 수)"""
+    if args.endpoint == "health":
+        return "GET", "/health", None, 1
+    if args.endpoint == "batch":
+        items = [route_request(args, i * args.batch_size + j) for j in range(args.batch_size)]
+        return "POST", "/batch", items, args.batch_size
+    return "POST", "/route", route_request(args, i), 1
+
+
+# ── 실행 ──
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        for i in range(args.warmup):
+            method, path, body, _ = build_call(args, -1 - i)
+            await client.request(method, path, json=body)
+
+        lag_before = await scrape_loop_lag(client)
+        latencies: List[float] = []
+        statuses: Dict[str, int] = {}
+        items_done = 0
+        next_index = 0
+        deadline = time.monotonic() + args.duration if args.duration else None
+
+        def claim() -> Optional[int]:
+            nonlocal next_index
+            if deadline is not None:
+                if time.monotonic() >= deadline:
+                    return None
+            elif next_index >= args.requests:
+                return None
+            next_index += 1
+            return next_index - 1
+
+        async def worker():
+            nonlocal items_done
+            while (i := claim()) is not None:
+                method, path, body, items = build_call(args, i)
+                started = time.perf_counter()
+                try:
+                    response = await client.request(method, path, json=body)
+                    status = str(response.status_code)
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append((time.perf_counter() - started) * 1000)
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == "200":
+                    items_done += items
+
+        client_lag: List[float] = []
+        lag_task = asyncio.create_task(client_loop_lag(client_lag))
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+        lag_task.cancel()
+
+        lag_after = await scrape_loop_lag(client)
+
+    total = len(latencies)
+    ok = statuses.get("200", 0)
+    return {
+        "requests": total,
+        "succeeded": ok,
+        "error_rate": round(1 - ok / total, 4) if total else 0.0,
+        "statuses": statuses,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "items_per_second": round(items_done / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": summarize(latencies),
+        "router_loop_lag_ms": histogram_delta(lag_before, lag_after) if lag_before and lag_after else None,
+        "client_loop_lag_ms": summarize(client_lag),
+    }
+
+
+def lookup(result: Dict[str, Any], dotted: str) -> Optional[float]:
+    value: Any = result
+    for key in dotted.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value if isinstance(value, (int, float)) else None
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> Dict[str, Any]:
+    """주요 지표의 이전 결과 대비 변화율 (%)"""
+    report = {}
+    for key in COMPARE_KEYS:
+        now, before = lookup(current["results"], key), lookup(baseline["results"], key)
+        if now is None or before is None:
+            continue
+        change = round((now - before) / before * 100, 1) if before else None
+        report[key] = {"baseline": before, "current": now, "change_pct": change}
+    return {"baseline_commit": baseline.get("git_commit"), "metrics": report}
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="LLM 라우터 부하 생성기")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="라우터 주소")
+    parser.add_argument("--endpoint", choices=["route", "batch", "health"], default="route")
+    parser.add_argument("--concurrency", type=int, default=8, help="동시 요청 수")
+    parser.add_argument("--requests", type=int, default=200, help="총 요청 수 (--duration이 없을 때)")
+    parser.add_argument("--duration", type=float, default=0, help="지정 시 요청 수 대신 이 시간(초) 동안 실행")
+    parser.add_argument("--warmup", type=int, default=2, help="측정 전 워밍업 요청 수")
+    parser.add_argument("--batch-size", type=int, default=8, help="/batch 요청 1건당 항목 수")
+    parser.add_argument("--prompt", default="hello.py 파일의 오타를 수정해줘")
+    parser.add_argument("--unique", action="store_true", help="요청마다 다른 프롬프트 사용 (캐시 우회)")
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--external-doc-kb", type=int, default=0, help="요청마다 첨부할 외부 문서 크기 (KB)")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--label", default="", help="결과 파일 이름에 붙일 표식")
+    parser.add_argument("--out", default=str(RESULTS_DIR), help="결과 JSON 저장 디렉토리 (빈 값이면 저장 안 함)")
+    parser.add_argument("--compare", help="비교할 이전 결과 JSON 경로")
+    args = parser.parse_args(argv)
+
+    commit = git_commit()
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": commit,
+        "config": vars(args),
+        "results": asyncio.run(run(args)),
+    }
+    if args.compare:
+        report["comparison"] = compare(report, json.loads(Path(args.compare).read_text(encoding="utf-8")))
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.out:
+        out_dir = Path(args.out)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        name = "-".join(part for part in (args.endpoint, args.label, stamp, commit) if part)
+        out_path = out_dir / f"{name}.json"
+        out_path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"결과 저장: {out_path}")
+
+
+if __name__ == "__main__":
+    main()
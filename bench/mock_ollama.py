@@ -0,0 +1,220 @@
+"""
+벤치마크용 Ollama 모의 서버
+
+실제 8B/51GB 모델 없이 라우터 자체 오버헤드(큐잉, 캐시, 직렬화, 이벤트 루프)를 측정하기 위해
+/api/generate, /api/chat, /api/ps 를 흉내 낸다. 첫 토큰 지연, 토큰 생성 속도, 스트리밍,
+오류 주입을 옵션으로 조절할 수 있다. format(JSON 스키마)이 주어지면 스키마에 맞는 JSON을 생성하므로
+Gateway 라우팅 판단/청크 보안 스캔/배치 분류도 그대로 통과한다.
+
+사용 예:
+    python bench/mock_ollama.py --port 11500 --ttft-ms 80 --tokens-per-second 120
+    MACBOOK_OLLAMA=http://127.0.0.1:11500 WORKER_ENDPOINTS=http://127.0.0.1:11500 python router.py
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Any, Dict, List, Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+DEFAULT_MODELS = ["llama3.1:8b", "qwen3-coder-next:q4_K_M"]
+# 스키마의 enum 값 중 우선 선택할 값 (라우팅이 차단/위임 없이 Worker까지 진행되도록)
+PREFERRED_ENUM_VALUES = {"하", "CODER", "LOW"}
+FILLER_WORDS = ["mock", "token", "router", "benchmark", "response", "worker", "gateway", "ollama"]
+
+
+class MockConfig:
+    """모의 서버 동작 설정 (명령줄 인자에서 생성)"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.ttft = args.ttft_ms / 1000
+        self.prompt_tokens_per_second = args.prompt_tokens_per_second
+        self.tokens_per_second = args.tokens_per_second
+        self.response_tokens = args.response_tokens
+        self.jitter = args.jitter
+        self.error_rate = args.error_rate
+        self.error_status = args.error_status
+        self.stream_error_rate = args.stream_error_rate
+        self.load_ms = args.load_ms
+        self.models = args.models
+
+    def delay(self, seconds: float) -> float:
+        """지터(±비율)를 적용한 지연 시간"""
+        if self.jitter <= 0:
+            return seconds
+        return max(seconds * random.uniform(1 - self.jitter, 1 + self.jitter), 0.0)
+
+
+def sample_from_schema(schema: Dict[str, Any], prompt: str) -> Any:
+    """JSON 스키마를 만족하는 최소 값 생성 (Ollama format 제약 흉내)"""
+    if "enum" in schema:
+        preferred = [value for value in schema["enum"] if value in PREFERRED_ENUM_VALUES]
+        return (preferred or schema["enum"])[0]
+    kind = schema.get("type")
+    if kind == "object":
+        return {key: sample_from_schema(value, prompt) for key, value in schema.get("properties", {}).items()}
+    if kind == "array":
+        items = schema.get("items", {})
+        if "index" in items.get("properties", {}):
+            # 배치 분류: <item index="i"> 마다 하나씩
+            count = prompt.count("<item index=")
+            return [{**sample_from_schema(items, prompt), "index": i} for i in range(count)]
+        return []
+    if kind == "boolean":
+        return False
+    if kind in ("integer", "number"):
+        return 0
+    if kind == "string":
+        return "mock decision"[:schema.get("maxLength", 200)]
+    return None
+
+
+def prompt_text(body: Dict[str, Any]) -> str:
+    if "messages" in body:
+        return "\n".join(message.get("content", "") for message in body["messages"])
+    return f"{body.get('system', '')}\n{body.get('prompt', '')}"
+
+
+def response_pieces(body: Dict[str, Any], prompt: str, config: MockConfig) -> List[str]:
+    """응답을 토큰 단위 조각으로 생성 (format이 있으면 JSON 문자열을 4자씩 나눔)"""
+    schema = body.get("format")
+    if isinstance(schema, dict):
+        text = json.dumps(sample_from_schema(schema, prompt), ensure_ascii=False)
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+    if schema == "json":
+        return ["{}"]
+    limit = (body.get("options") or {}).get("num_predict") or config.response_tokens
+    count = max(min(config.response_tokens, limit), 1)
+    return [f"{FILLER_WORDS[i % len(FILLER_WORDS)]} " for i in range(count)]
+
+
+def final_stats(prompt_tokens: int, eval_tokens: int, prompt_s: float, eval_s: float,
+                load_s: float) -> Dict[str, Any]:
+    """Ollama done 청크의 통계 필드 (나노초 단위)"""
+    return {
+        "done": True,
+        "done_reason": "stop",
+        "total_duration": int((load_s + prompt_s + eval_s) * 1e9),
+        "load_duration": int(load_s * 1e9),
+        "prompt_eval_count": prompt_tokens,
+        "prompt_eval_duration": int(prompt_s * 1e9),
+        "eval_count": eval_tokens,
+        "eval_duration": int(eval_s * 1e9),
+    }
+
+
+def create_app(config: MockConfig) -> FastAPI:
+    app = FastAPI(title="Mock Ollama")
+    loaded = set()  # 한 번 호출된 모델 - 첫 요청에만 load_ms 지연
+
+    @app.get("/")
+    async def root():
+        return PlainTextResponse("Ollama is running")
+
+    @app.get("/api/version")
+    async def version():
+        return {"version": "0.0.0-mock"}
+
+    @app.get("/api/ps")
+    async def ps():
+        return {
+            "models": [
+                {
+                    "name": model,
+                    "model": model,
+                    "size": 8 * 1024 ** 3,
+                    "size_vram": 8 * 1024 ** 3,
+                    "expires_at": "2099-01-01T00:00:00.000000000+00:00",
+                }
+                for model in config.models
+            ]
+        }
+
+    async def generate(request: Request, chat: bool):
+        body = await request.json()
+        model = body.get("model", "")
+        if random.random() < config.error_rate:
+            return JSONResponse({"error": "injected failure"}, status_code=config.error_status)
+
+        load_s = 0.0
+        if model not in loaded:
+            load_s = config.load_ms / 1000
+            loaded.add(model)
+            await asyncio.sleep(load_s)
+
+        prompt = prompt_text(body)
+        is_warmup = not prompt.strip() and not body.get("messages")
+        pieces = [] if is_warmup else response_pieces(body, prompt, config)
+        prompt_tokens = max(len(prompt) // 4, 1)
+        prompt_s = config.delay(config.ttft + prompt_tokens / config.prompt_tokens_per_second)
+        token_s = 1 / config.tokens_per_second
+
+        def chunk(piece: str, done: bool = False) -> Dict[str, Any]:
+            data: Dict[str, Any] = {"model": model, "done": done}
+            if chat:
+                data["message"] = {"role": "assistant", "content": piece}
+            else:
+                data["response"] = piece
+            return data
+
+        if not body.get("stream", True):
+            eval_s = config.delay(token_s * len(pieces))
+            await asyncio.sleep(prompt_s + eval_s)
+            data = chunk("".join(pieces), done=True)
+            data.update(final_stats(prompt_tokens, len(pieces), prompt_s, eval_s, load_s))
+            return data
+
+        async def stream():
+            await asyncio.sleep(prompt_s)
+            started = time.monotonic()
+            fail_at = random.randrange(len(pieces)) if pieces and random.random() < config.stream_error_rate else None
+            for i, piece in enumerate(pieces):
+                if i == fail_at:
+                    yield json.dumps({"error": "injected stream failure"}) + "\n"
+                    return
+                await asyncio.sleep(config.delay(token_s))
+                yield json.dumps(chunk(piece), ensure_ascii=False) + "\n"
+            data = chunk("", done=True)
+            data.update(final_stats(prompt_tokens, len(pieces), prompt_s, time.monotonic() - started, load_s))
+            yield json.dumps(data) + "\n"
+
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+    @app.post("/api/generate")
+    async def api_generate(request: Request):
+        return await generate(request, chat=False)
+
+    @app.post("/api/chat")
+    async def api_chat(request: Request):
+        return await generate(request, chat=True)
+
+    return app
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="벤치마크용 Ollama 모의 서버")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--ttft-ms", type=float, default=50, help="첫 토큰까지 기본 지연 (ms)")
+    parser.add_argument("--prompt-tokens-per-second", type=float, default=2000,
+                        help="프롬프트 처리 속도 (입력 길이에 비례해 첫 토큰 지연 증가)")
+    parser.add_argument("--tokens-per-second", type=float, default=100, help="디코딩 속도")
+    parser.add_argument("--response-tokens", type=int, default=64, help="일반 응답 토큰 수 (num_predict가 더 작으면 그 값)")
+    parser.add_argument("--jitter", type=float, default=0.1, help="지연 시간 무작위 변동 비율 (0~1)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="HTTP 오류로 응답할 확률")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--stream-error-rate", type=float, default=0.0, help="스트림 도중 error 청크를 보낼 확률")
+    parser.add_argument("--load-ms", type=float, default=0, help="모델별 첫 요청의 로드 지연 (ms)")
+    parser.add_argument("--models", nargs="+", default=DEFAULT_MODELS, help="/api/ps에 상주 중으로 보고할 모델")
+    args = parser.parse_args(argv)
+
+    uvicorn.run(create_app(MockConfig(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Worker 입장 대기열 테스트"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import router  # noqa: E402
+from router import AdmissionQueue  # noqa: E402
+
+
+def test_unused_ticket_release_is_idempotent():
+    async def scenario():
+        queue = AdmissionQueue(capacity=1, max_depth=4)
+        running = queue.enter("interactive")
+        waiting = queue.enter("interactive")
+        waiting.release()  # 슬롯을 받기 전 포기 - 대기열에서만 빠짐
+        waiting.release()
+        assert queue.waiting() == [] and queue.active == 1
+        running.release()
+        running.release()
+        return queue
+
+    assert asyncio.run(scenario()).active == 0
+
+
+def test_stream_rejection_counts_once(monkeypatch):
+    """/route/stream은 스트림 시작 전 한 번만 입장 시도 - 거절 1건은 rejected 1"""
+    async def no_history(_req):
+        return 0
+
+    async def allow(_req, _failure_history, decision=None):
+        return router.fallback_decision("test"), "CODER"
+
+    async def allow_budget(_req):
+        pass
+
+    queue = AdmissionQueue(capacity=1, max_depth=0)
+    monkeypatch.setattr(router, "failure_history_for", no_history)
+    monkeypatch.setattr(router, "resolve_route", allow)
+    monkeypatch.setattr(router, "check_context_budget", allow_budget)
+    monkeypatch.setattr(router.router_engine, "admission", queue)
+
+    async def scenario():
+        queue.enter("interactive")
+        await router.route_stream(router.LLMRequest(prompt="stream"))
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(scenario())
+
+    assert exc.value.status_code == 429
+    assert queue.rejected == 1
@@ -0,0 +1,36 @@
+"""Gateway 실패 처리 테스트 - 어떤 통신 실패든 서킷 열림과 같이 기본 CODER로 폴백"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import httpx
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import router  # noqa: E402
+
+
+def _malformed_ndjson(_request: httpx.Request) -> httpx.Response:
+    return httpx.Response(200, content=b'{"response": "{\\"diff"}\nnot json\n')
+
+
+def _refused(request: httpx.Request) -> httpx.Response:
+    raise httpx.ConnectError("connection refused", request=request)
+
+
+def _open_circuit(_request: httpx.Request) -> httpx.Response:
+    raise router.CircuitOpenError("http://gateway", 30)
+
+
+@pytest.mark.parametrize("handler", [_malformed_ndjson, _refused, _open_circuit])
+def test_gateway_failure_falls_back_to_coder(monkeypatch, handler):
+    client = httpx.AsyncClient(base_url="http://gateway", transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(router.router_engine, "client_for", lambda _model: client)
+    monkeypatch.setattr(router.router_engine, "decision_cache", router.DecisionCache())
+    monkeypatch.setattr(router.router_engine, "fast_path", None)
+
+    decision = asyncio.run(router.router_engine.analyze_with_gateway(f"gateway failure {handler.__name__}"))
+
+    assert decision.next_agent == "CODER" and "Gateway 오류" in decision.reason
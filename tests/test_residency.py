@@ -0,0 +1,54 @@
+"""모델 상주 관리 루프 테스트 - 잘못된 /api/ps 응답에도 루프가 멈추지 않아야 한다"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import router  # noqa: E402
+
+
+class _Clients:
+    """OllamaClientPool 대신 - 모든 노드 요청을 MockTransport로 응답"""
+
+    def __init__(self, handler):
+        self.client = httpx.AsyncClient(base_url="http://node", transport=httpx.MockTransport(handler))
+
+    def get(self, _base_url: str) -> httpx.AsyncClient:
+        return self.client
+
+
+def test_residency_loop_survives_malformed_ps(monkeypatch):
+    bodies = [b"not json", b"[]", b'{"models": [{"name": "m", "size": 0}]}']
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request.url.path)
+        return httpx.Response(200, content=bodies[min(len(calls), len(bodies)) - 1])
+
+    monkeypatch.setattr(router, "RESIDENCY_POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(router, "RESIDENCY_KEEP_WARM", False)
+
+    async def scenario():
+        residency = router.ModelResidency(router.router_engine.context_ladders)
+        residency.expected = {"http://node": ["m"]}
+        residency.resident, residency.reachable = {"http://node": {}}, {"http://node": False}
+        task = asyncio.create_task(residency.run(_Clients(handler)))
+
+        async def polled():
+            while len(calls) < len(bodies) + 1 and not task.done():
+                await asyncio.sleep(0.01)
+
+        await asyncio.wait_for(polled(), timeout=5)
+        alive = not task.done()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return alive, residency
+
+    alive, residency = asyncio.run(scenario())
+
+    assert alive
+    assert residency.reachable["http://node"] and residency.is_resident("m")
@@ -0,0 +1,57 @@
+"""Gateway 판단 로그 테스트 - 프롬프트 원문은 ROUTING_LOG_PROMPTS=1일 때만 기록"""
+
+import hashlib
+import json
+import logging
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import router  # noqa: E402
+
+
+class _Capture(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(json.loads(record.getMessage()))
+
+
+@pytest.fixture
+def capture(monkeypatch):
+    handler = _Capture()
+    decision_log = logging.getLogger("routing-log-test")
+    decision_log.propagate = False
+    decision_log.addHandler(handler)
+    monkeypatch.setattr(router, "_decision_log", decision_log)
+    return handler.records
+
+
+@pytest.mark.parametrize("log_prompts", [False, True])
+def test_prompt_text_is_opt_in(monkeypatch, capture, log_prompts):
+    monkeypatch.setattr(router, "ROUTING_LOG_PROMPTS", log_prompts)
+
+    router.log_routing_decision("비밀 프롬프트", None, 0, router.fallback_decision("test"))
+
+    record = capture[-1]
+    if log_prompts:
+        assert record["prompt"] == "비밀 프롬프트"
+    else:
+        assert "prompt" not in record and record["prompt_chars"] == len("비밀 프롬프트")
+        assert record["prompt_sha256"] == hashlib.sha256("비밀 프롬프트".encode("utf-8")).hexdigest()
+
+
+def test_training_skips_hashed_records(tmp_path):
+    log_path = tmp_path / "routing_decisions.jsonl"
+    decision = router.fallback_decision("test").model_dump()
+    log_path.write_text("".join(
+        json.dumps({"prompt_chars": 3, "prompt_sha256": "x", "decision": decision}) + "\n" for _ in range(12)
+    ), encoding="utf-8")
+
+    with pytest.raises(ValueError, match="ROUTING_LOG_PROMPTS=1"):
+        router.train_fast_path_classifier(log_path)
@@ -0,0 +1,67 @@
+"""세션 모드 추측 실행 테스트 - Gateway가 허용한 턴만 이력에 남아야 한다"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import router  # noqa: E402
+
+
+def _patch_route(monkeypatch, block: bool):
+    async def no_history(_req):
+        return 0
+
+    async def allow_budget(_req):
+        pass
+
+    async def loaded():
+        pass
+
+    async def gateway(_req, _failure_history, decision=None):
+        await asyncio.sleep(0.05)  # Worker가 먼저 끝난 뒤 결정
+        if block:
+            raise HTTPException(status_code=403, detail={"error": "보안 위협 감지"})
+        return router.fallback_decision("test"), "CODER"
+
+    async def worker(prompt, temperature, max_tokens, session, context, progress=None):
+        messages = session.chat_messages(session.user_content(prompt, context))
+        data = {"response": "blocked output", "done": True, "eval_count": 3}
+        session.record_turn("http://worker", messages, context, data)
+        return data
+
+    monkeypatch.setattr(router, "failure_history_for", no_history)
+    monkeypatch.setattr(router, "check_context_budget", allow_budget)
+    monkeypatch.setattr(router, "resolve_route", gateway)
+    monkeypatch.setattr(router.router_engine, "ensure_worker_loaded", loaded)
+    monkeypatch.setattr(router.router_engine, "collect_worker", worker)
+    monkeypatch.setattr(router.router_engine, "sessions", router.SessionStore())
+
+
+def _request(session_id: str) -> router.LLMRequest:
+    return router.LLMRequest(prompt="turn", session_id=session_id, speculative=True)
+
+
+def test_blocked_speculative_turn_is_not_recorded(monkeypatch):
+    _patch_route(monkeypatch, block=True)
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(router.execute_route(_request("blocked")))
+
+    assert exc.value.status_code == 403
+    session = router.router_engine.sessions.get("blocked")
+    assert session.messages == [] and session.turns == 0
+
+
+def test_allowed_speculative_turn_is_recorded(monkeypatch):
+    _patch_route(monkeypatch, block=False)
+
+    asyncio.run(router.execute_route(_request("allowed")))
+
+    session = router.router_engine.sessions.get("allowed")
+    assert session.turns == 1
+    assert session.messages[-1] == {"role": "assistant", "content": "blocked output"}
@@ -0,0 +1,86 @@
+"""SingleFlight 스트림 공유 + 요청 시간 예산 테스트"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import router  # noqa: E402
+from router import SingleFlight, start_deadline  # noqa: E402
+
+
+async def _owner_stream(tokens: int = 10, interval: float = 0.05):
+    """worker_chunks와 같은 형태 - 대기열 순번, 토큰, 대기열 정보가 붙은 완료 청크"""
+    yield {"queued": 2}
+    for i in range(tokens):
+        await asyncio.sleep(interval)
+        yield {"response": f"t{i}", "done": False}
+    yield {"response": "", "done": True, "eval_count": tokens, "queue_position": 2, "queue_wait_ms": 1.0}
+
+
+async def _subscribe(flight: SingleFlight, budget_ms: float, delay: float = 0.0):
+    await asyncio.sleep(delay)
+    start_deadline(budget_ms)
+    return [chunk async for chunk in flight.stream("key", _owner_stream)]
+
+
+def test_joiner_with_shorter_deadline_gets_partial_done():
+    async def scenario():
+        flight = SingleFlight()
+        return await asyncio.gather(_subscribe(flight, 0), _subscribe(flight, 180, delay=0.01))
+
+    owner, joiner = asyncio.run(scenario())
+
+    assert owner[-1]["done"] and owner[-1]["eval_count"] == 10
+    done = joiner[-1]
+    assert done["done"] and done["done_reason"] == "deadline"
+    tokens = [chunk for chunk in joiner if not chunk.get("done") and "queued" not in chunk]
+    assert done["eval_count"] == len(tokens) < 10  # 대기열 순번 알림은 토큰으로 세지 않음
+    assert "queue_position" not in done
+
+
+def test_stream_joiner_deadline_ends_with_done_event(monkeypatch):
+    """/route/stream 합류 구독자의 예산이 먼저 끝나도 error가 아니라 부분 결과 done 이벤트로 끝나야 한다"""
+    async def no_history(_req):
+        return 0
+
+    async def allow(_req, _failure_history, decision=None):
+        return router.fallback_decision("test"), "CODER"
+
+    async def loaded():
+        pass
+
+    async def allow_budget(_req):
+        pass
+
+    async def owner_chunks(_req, _priority, _session, ticket):
+        try:
+            async for chunk in _owner_stream():
+                yield chunk
+        finally:
+            ticket.release()
+
+    monkeypatch.setattr(router, "failure_history_for", no_history)
+    monkeypatch.setattr(router, "resolve_route", allow)
+    monkeypatch.setattr(router, "check_context_budget", allow_budget)
+    monkeypatch.setattr(router, "worker_chunks", owner_chunks)
+    monkeypatch.setattr(router.router_engine, "ensure_worker_loaded", loaded)
+    monkeypatch.setattr(router.router_engine, "inflight", SingleFlight())
+    monkeypatch.setattr(router.router_engine, "response_cache", None)
+    monkeypatch.setattr(router, "DEADLINE_FLIGHT_BUCKET_MS", 1e12)  # 두 예산이 같은 구간 → 같은 스트림 공유
+
+    async def events(deadline_ms: float, delay: float = 0.0):
+        await asyncio.sleep(delay)
+        response = await router.route_stream(router.LLMRequest(prompt="stream", deadline_ms=deadline_ms))
+        return [frame async for frame in response.body_iterator]
+
+    async def scenario():
+        return await asyncio.gather(events(5000), events(180, delay=0.01))
+
+    owner, joiner = asyncio.run(scenario())
+
+    assert router.router_engine.admission.active == 0  # 합류한 요청의 입장권도 반납됨
+    assert owner[-1].startswith("event: done") and '"tokens_generated": 10' in owner[-1]
+    assert joiner[-1].startswith("event: done") and '"done_reason": "deadline"' in joiner[-1]
+    assert not any(frame.startswith("event: error") for frame in joiner)
@@ -0,0 +1,49 @@
+"""스냅샷 저널 테스트 - 기록마다 한 줄 추가, 주기적 압축, 끊긴 줄 복구"""
+
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from router import SnapshotJournal  # noqa: E402
+
+
+def _snapshot(i: int) -> dict:
+    return {"timestamp": f"t{i}", "last_requirement": f"작업 {i}"}
+
+
+def test_save_appends_one_line(tmp_path):
+    journal = SnapshotJournal(tmp_path, ring_size=10)
+    journal.save(_snapshot(1))
+    before, inode = journal.journal_path.read_bytes(), journal.journal_path.stat().st_ino
+
+    record = journal.save(_snapshot(2))
+
+    after = journal.journal_path.read_bytes()
+    assert journal.journal_path.stat().st_ino == inode  # 파일 교체가 아니라 추가
+    assert after.startswith(before) and after.count(b"\n") == 2
+    assert record["seq"] == 2 and journal.load_latest() == record
+
+
+def test_journal_compacts_to_ring_size(tmp_path):
+    journal = SnapshotJournal(tmp_path, ring_size=4)
+    for i in range(11):
+        journal.save(_snapshot(i))
+
+    lines = journal.journal_path.read_text(encoding="utf-8").splitlines()
+    assert len(lines) <= 2 * journal.ring_size
+    assert [r["seq"] for r in journal.history(limit=100)] == [11, 10, 9, 8]
+
+
+def test_torn_last_line_is_skipped(tmp_path):
+    journal = SnapshotJournal(tmp_path, ring_size=10)
+    journal.save(_snapshot(1))
+    with open(journal.journal_path, "a", encoding="utf-8") as f:
+        f.write('{"seq": 2, "last_requ')  # 쓰는 도중 중단된 기록
+
+    record = journal.save(_snapshot(3))
+
+    assert record["seq"] == 2
+    assert [r["seq"] for r in journal.history()] == [2, 1]
+    assert json.loads(journal.journal_path.read_text(encoding="utf-8").splitlines()[-1]) == record